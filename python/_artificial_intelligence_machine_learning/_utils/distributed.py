@@ -0,0 +1,44 @@
+"""
+Optional multi-GPU (DDP) setup for scripts launched with torchrun
+
+Author: Sam Barba
+Created 14/10/2026
+"""
+
+import os
+import sys
+
+import torch
+import torch.distributed as dist
+
+
+def init_distributed(seed):
+	"""Returns (global rank, local rank i.e. GPU index, world size), which are (0, 0, 1) for a plain `python main.py`"""
+
+	rank = int(os.getenv('RANK', 0))
+	local_rank = int(os.getenv('LOCAL_RANK', 0))
+	world_size = int(os.getenv('WORLD_SIZE', 1))
+
+	if world_size > 1:
+		dist.init_process_group(backend='nccl' if sys.platform == 'linux' else 'gloo')
+		torch.cuda.set_device(local_rank)
+		torch.manual_seed(seed + rank)  # Per-rank random streams (DDP syncs the initial weights anyway)
+
+	return rank, local_rank, world_size
+
+
+def mean_over_ranks(value):
+	"""Averages a scalar over all ranks, so they all get exactly the same value (e.g. for early stopping)"""
+
+	if not dist.is_initialized():
+		return value
+
+	value = torch.tensor(value, dtype=torch.float64, device='cuda' if dist.get_backend() == 'nccl' else 'cpu')
+	dist.all_reduce(value)
+
+	return value.item() / dist.get_world_size()
+
+
+def cleanup_distributed():
+	if dist.is_initialized():
+		dist.destroy_process_group()
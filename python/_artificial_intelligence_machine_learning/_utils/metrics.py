@@ -0,0 +1,30 @@
+"""
+On-device classification metrics (avoids syncing the GPU and copying to the CPU for sklearn)
+
+Author: Sam Barba
+Created 14/10/2026
+"""
+
+import torch
+
+
+def confusion_matrix(y_true, y_pred, num_classes):
+	cm = torch.zeros((num_classes, num_classes), dtype=torch.int64, device=y_true.device)
+	cm.index_put_((y_true, y_pred), torch.ones_like(y_true), accumulate=True)
+
+	return cm
+
+
+def weighted_f1_score(y_true, y_pred, num_classes):
+	"""Equivalent to sklearn's f1_score(y_true, y_pred, average='weighted'), but returns a tensor on the same device"""
+
+	cm = confusion_matrix(y_true, y_pred, num_classes)
+	tp = cm.diag().float()
+	support = cm.sum(dim=1).float()  # No. true samples per class
+	num_pred = cm.sum(dim=0).float()  # No. predicted samples per class
+
+	precision = tp / num_pred.clamp(min=1)
+	recall = tp / support.clamp(min=1)
+	f1 = 2 * precision * recall / (precision + recall).clamp(min=1e-12)
+
+	return (f1 * support).sum() / support.sum()
@@ -7,7 +7,7 @@ Created 03/03/2022
 
 import matplotlib.pyplot as plt
 import numpy as np
-from sklearn.metrics import mean_absolute_error
+from scipy.linalg import cho_solve
 
 import bayesian_utility
 
@@ -50,35 +50,46 @@ def plot_regression(approx_data, x_train, y_train, x_test, y_test, lam, lower_bo
 	plt.show()
 
 
-def fit_pls(phi, y, lam):
-	"""Partial least squares"""
+def fit_pls(gram, phi_t_y, lam):
+	"""
+	Partial least squares, given precomputed phi^T phi (gram) and phi^T y so that they can be reused across lambda
+	values. Solves via Cholesky decomposition instead of an explicit inverse.
+	"""
 
-	return np.linalg.inv(phi.T.dot(phi) + lam * np.eye(phi.shape[1])).dot(phi.T).dot(y)
+	chol = np.linalg.cholesky(gram + lam * np.eye(len(gram)))
+	return cho_solve((chol, True), phi_t_y)
 
 
-def compute_posterior(phi, y, alpha, s2):
+def compute_posterior(gram, phi_t_y, alpha, s2):
 	"""
 	Compute posterior mean (mu) and variance (sigma) for a Bayesian linear regression model with basis matrix
-	phi and hyperparameters alpha and sigma^2, where lambda = alpha * sgima^2 (lambda = regularisation parameter)
+	phi and hyperparameters alpha and sigma^2, where lambda = alpha * sgima^2 (lambda = regularisation parameter),
+	given precomputed phi^T phi (gram) and phi^T y
 	"""
 
 	lam = alpha * s2
-	mu = np.linalg.inv(phi.T.dot(phi) + lam * np.eye(phi.shape[1])).dot(phi.T).dot(y)
-	sigma = s2 * np.linalg.inv(phi.T.dot(phi) + lam * np.eye(phi.shape[1]))
+	chol = np.linalg.cholesky(gram + lam * np.eye(len(gram)))
+	mu = cho_solve((chol, True), phi_t_y)
+	sigma = s2 * cho_solve((chol, True), np.eye(len(gram)))
 	return mu, sigma
 
 
-def compute_log_marginal(phi, y, alpha, s2):
+def compute_log_marginal(phi_svd, y, alpha, s2):
 	"""
 	Compute the logarithm of the marginal likelihood for a Bayesian linear regression model
-	with basis matrix phi and hyperparameters alpha and sigma^2
+	with hyperparameters alpha and sigma^2, given the thin SVD (U, S) of basis matrix phi.
+	The covariance s2 * I + phi phi^T / alpha has eigenvalues s2 + S^2 / alpha along the columns of U
+	(and s2 elsewhere), so its log determinant and inverse quadratic form don't need O(n^3) operations.
 	"""
 
+	u, s = phi_svd
 	y = y.squeeze()
-	n = phi.shape[0]
-	lml1 = (2 * np.pi) ** (-n / 2) * np.linalg.det(s2 * np.eye(n) + phi.dot(phi.T) / alpha) ** -0.5
-	lml2 = np.exp(-0.5 * y.T.dot(np.linalg.inv(s2 * np.eye(n) + phi.dot(phi.T) / alpha)).dot(y))
-	return np.log(lml1 * lml2)
+	n = len(y)
+	cov_eigvals = s2 + s ** 2 / alpha
+	u_t_y = u.T.dot(y)
+	log_det = np.log(cov_eigvals).sum() + (n - len(s)) * np.log(s2)
+	quad_form = (u_t_y ** 2 / cov_eigvals).sum() + (y.dot(y) - u_t_y.dot(u_t_y)) / s2
+	return -0.5 * (n * np.log(2 * np.pi) + log_det + quad_form)
 
 
 if __name__ == '__main__':
@@ -100,17 +111,25 @@ if __name__ == '__main__':
 	phi_val = rbf_generator.evaluate(x_val)
 	phi_test = rbf_generator.evaluate(x_test)
 
+	# Precompute the parts of the fit that don't depend on lambda
+
+	gram_train = phi_train.T.dot(phi_train)
+	phi_t_y_train = phi_train.T.dot(y_train)
+	u_train, s_train, _ = np.linalg.svd(phi_train, full_matrices=False)
+
 	# Plot regression for different lambda values
 	for lam in [0, 0.01, 10]:
-		w = fit_pls(phi_train, y_train, lam)
+		w = fit_pls(gram_train, phi_t_y_train, lam)
 		approx_data = phi_test.dot(w)
 		plot_regression(approx_data, x_train, y_train, x_test, y_test, lam)
 
 	# Check consistency of fit_pls and compute_posterior
 	# (let lambda = 0.01, so alpha = 0.01 / sigma^2)
 
-	mu, _ = compute_posterior(phi_test, y_test, alpha=0.01 / SIGMA ** 2, s2=SIGMA ** 2)
-	w = fit_pls(phi_test, y_test, lam=0.01)
+	gram_test = phi_test.T.dot(phi_test)
+	phi_t_y_test = phi_test.T.dot(y_test)
+	mu, _ = compute_posterior(gram_test, phi_t_y_test, alpha=0.01 / SIGMA ** 2, s2=SIGMA ** 2)
+	w = fit_pls(gram_test, phi_t_y_test, lam=0.01)
 	print('mu = PLS w:', all(mu == w))
 
 	# Compute train, validation, and test set errors for the PLS model
@@ -120,23 +139,20 @@ if __name__ == '__main__':
 	v = np.linspace(-13, 5, 500)
 	lam_vals = 10 ** v
 
-	err_train = np.zeros(0)
-	err_test = np.zeros(0)
-	err_val = np.zeros(0)
-	neg_log_evidence = np.zeros(0)
+	err_train = np.empty(len(lam_vals))
+	err_test = np.empty(len(lam_vals))
+	err_val = np.empty(len(lam_vals))
+	neg_log_evidence = np.empty(len(lam_vals))
 
-	for lam in lam_vals:
-		w = fit_pls(phi_train, y_train, lam)
+	for i, lam in enumerate(lam_vals):
+		w = fit_pls(gram_train, phi_t_y_train, lam)
 		train_pred = phi_train.dot(w)
 		test_pred = phi_test.dot(w)
 		val_pred = phi_val.dot(w)
-		err_train = np.append(err_train, mean_absolute_error(y_train, train_pred))
-		err_test = np.append(err_test, mean_absolute_error(y_test, test_pred))
-		err_val = np.append(err_val, mean_absolute_error(y_val, val_pred))
-		neg_log_evidence = np.append(
-			neg_log_evidence,
-			-compute_log_marginal(phi_train, y_train, lam / SIGMA ** 2, SIGMA ** 2)
-		)
+		err_train[i] = np.abs(y_train - train_pred).mean()
+		err_test[i] = np.abs(y_test - test_pred).mean()
+		err_val[i] = np.abs(y_val - val_pred).mean()
+		neg_log_evidence[i] = -compute_log_marginal((u_train, s_train), y_train, lam / SIGMA ** 2, SIGMA ** 2)
 
 	ax1 = plt.subplot()
 	ax2 = ax1.twinx()
@@ -173,7 +189,7 @@ if __name__ == '__main__':
 	print('\nOptimal lambda =', best_lam)
 	print('Optimal alpha =', best_alpha)
 
-	mu, sigma = compute_posterior(phi_train, y_train, alpha=best_alpha, s2=SIGMA ** 2)
+	mu, sigma = compute_posterior(gram_train, phi_t_y_train, alpha=best_alpha, s2=SIGMA ** 2)
 	y_posterior = phi_test.dot(mu).squeeze()
 	var_matrix = SIGMA ** 2 + phi_test.dot(sigma).dot(phi_test.T)
 	var_matrix = var_matrix.diagonal()
@@ -185,4 +201,4 @@ if __name__ == '__main__':
 
 	# Print log marginal likelihood given optimal lambda and alpha
 	print(f'\nLog marginal likelihood with sigma^2 = {SIGMA ** 2}, lambda = optimal, alpha = optimal:')
-	print(compute_log_marginal(phi_train, y_train, best_alpha, SIGMA ** 2))
+	print(compute_log_marginal((u_train, s_train), y_train, best_alpha, SIGMA ** 2))
@@ -5,6 +5,7 @@ Author: Sam Barba
 Created 27/01/2024
 """
 
+from concurrent.futures import ThreadPoolExecutor
 import glob
 import os
 
@@ -16,12 +17,16 @@ from sklearn.metrics import f1_score
 from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import LabelEncoder
 import torch
-from torch.utils.data import DataLoader
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.utils.data import DataLoader, DistributedSampler
 from torchvision import transforms
 from tqdm import tqdm
 
 from _utils.custom_dataset import CustomDataset
+from _utils.distributed import cleanup_distributed, init_distributed, mean_over_ranks
 from _utils.early_stopping import EarlyStopping
+from _utils.metrics import weighted_f1_score
 from _utils.plotting import *
 from conv_net import CNN
 
@@ -39,21 +44,51 @@ BATCH_SIZE = 128
 LEARNING_RATE = 2e-4
 NUM_EPOCHS = 100
 DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
+USE_AMP = DEVICE == 'cuda'  # Mixed precision (FP16) for Tensor Core GPUs
+USE_COMPILE = DEVICE == 'cuda'  # The compile modes used here rely on CUDA graphs, and only repay compile time on GPU
+IMG_CACHE_PATH = f'./preprocessed_imgs_{INPUT_H}x{INPUT_W}.pt'
+
+
+def load_cached_imgs(img_paths):
+	# Returns the cached images if the cache exists and was built from exactly these paths, else None
+
+	if not os.path.exists(IMG_CACHE_PATH):
+		return None
+
+	cache = torch.load(IMG_CACHE_PATH, mmap=True)
+	if not isinstance(cache, dict) or cache['img_paths'] != img_paths:
+		return None
+
+	return cache['imgs']
 
 
 def create_data_loaders(df):
-	# Preprocess images now instead of during training (faster pipeline overall)
+	# Decode/resize images once and cache them as a single uint8 tensor of shape (N, 1, INPUT_H, INPUT_W), so later runs
+	# just load it. Normalisation to [0,1] happens after the H2D copy. The image paths are stored alongside, so the
+	# cache is rebuilt if the dataset (or its order) changes.
 
-	transform = transforms.Compose([
-		transforms.Resize((INPUT_H, INPUT_W)),
-		transforms.Grayscale(),
-		transforms.ToTensor()  # Automatically normalises to [0,1]
-	])
+	img_paths = df['img_path'].tolist()
 
-	x = [
-		transform(Image.open(img_path)) for img_path in
-		tqdm(df['img_path'], desc='Preprocessing images', unit='imgs', ascii=True)
-	]
+	if not dist.is_initialized() or dist.get_rank() == 0:
+		if load_cached_imgs(img_paths) is None:
+			transform = transforms.Compose([
+				transforms.Resize((INPUT_H, INPUT_W)),
+				transforms.Grayscale(),
+				transforms.PILToTensor()
+			])
+
+			# PIL releases the GIL while decoding/resizing, so threads can use all cores
+			with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+				x = executor.map(lambda img_path: transform(Image.open(img_path)), img_paths)
+				x = torch.stack(list(
+					tqdm(x, total=len(img_paths), desc='Preprocessing images', unit='imgs', ascii=True)
+				))
+			torch.save({'img_paths': img_paths, 'imgs': x}, IMG_CACHE_PATH)
+
+	if dist.is_initialized():
+		dist.barrier()  # Every rank waits here for rank 0 to check/write the cache
+
+	x = load_cached_imgs(img_paths)
 
 	label_encoder = LabelEncoder()
 	y = label_encoder.fit_transform(df['class'])
@@ -70,53 +105,69 @@ def create_data_loaders(df):
 	train_dataset = CustomDataset(x_train, y_train)
 	val_dataset = CustomDataset(x_val, y_val)
 	test_dataset = CustomDataset(x_test, y_test)
-	train_loader = DataLoader(train_dataset, batch_size=BATCH_SIZE, shuffle=False)
+	sampler = DistributedSampler(train_dataset, shuffle=False) if dist.is_initialized() else None
+	train_loader = DataLoader(
+		train_dataset, batch_size=BATCH_SIZE, sampler=sampler, num_workers=os.cpu_count(),
+		pin_memory=DEVICE == 'cuda', persistent_workers=True, prefetch_factor=4
+	)
 	val_loader = DataLoader(val_dataset, batch_size=len(x_val))
 	test_loader = DataLoader(test_dataset, batch_size=len(x_test))
 
 	return train_loader, val_loader, test_loader
 
 
-if __name__ == '__main__':
+def main():
+	rank, local_rank, world_size = init_distributed(seed=1)
+	distributed = world_size > 1
+
 	# Convert data to dataframe
 
 	data = []
-	for img_path in glob.iglob('C:/Users/Sam/Desktop/projects/datasets/alzheimers/*/*.jpg'):
+	for img_path in sorted(glob.iglob('C:/Users/Sam/Desktop/projects/datasets/alzheimers/*/*.jpg')):
 		class_name = img_path.split('\\')[1]
 		data.append((img_path, class_name))
 
 	df = pd.DataFrame(data, columns=['img_path', 'class'])
 
-	# Plot some examples
-
-	example_indices = [0, 1, 3200, 3201, 5440, 5441, 6336, 6337]
-	_, axes = plt.subplots(nrows=2, ncols=4, figsize=(6, 4))
-	plt.subplots_adjust(top=0.8)
-	for idx, ax in zip(example_indices, axes.flatten()):
-		sample = imread(df['img_path'][idx])
-		ax.imshow(sample)
-		ax.axis('off')
-		ax.set_title(df['class'][idx][2:].replace('_', ' '), fontsize=11)
-	plt.suptitle('Data samples', x=0.514, y=0.94)
-	plt.gcf().set_facecolor('#80b0f0')
-	plt.show()
-
-	# Plot output feature (class) distributions
-
-	unique_value_counts = df['class'].value_counts()
-	plt.bar(unique_value_counts.index, unique_value_counts.values)
-	plt.xlabel('Class')
-	plt.ylabel('Count')
-	plt.title('Class distribution')
-	plt.show()
+	if rank == 0:
+		# Plot some examples
+
+		example_indices = [0, 1, 3200, 3201, 5440, 5441, 6336, 6337]
+		_, axes = plt.subplots(nrows=2, ncols=4, figsize=(6, 4))
+		plt.subplots_adjust(top=0.8)
+		for idx, ax in zip(example_indices, axes.flatten()):
+			sample = imread(df['img_path'][idx])
+			ax.imshow(sample)
+			ax.axis('off')
+			ax.set_title(df['class'][idx][2:].replace('_', ' '), fontsize=11)
+		plt.suptitle('Data samples', x=0.514, y=0.94)
+		plt.gcf().set_facecolor('#80b0f0')
+		plt.show()
+
+		# Plot output feature (class) distributions
+
+		unique_value_counts = df['class'].value_counts()
+		plt.bar(unique_value_counts.index, unique_value_counts.values)
+		plt.xlabel('Class')
+		plt.ylabel('Count')
+		plt.title('Class distribution')
+		plt.show()
 
 	# Define data loaders and model
 
 	train_loader, val_loader, test_loader = create_data_loaders(df)
 
-	model = CNN().to(DEVICE)
-	print(f'\nModel:\n{model}\n')
-	plot_torch_model(model, (1, INPUT_H, INPUT_W), input_device=DEVICE)
+	# Val/test loaders are a single batch each, so fetch them once (val set stays on device for every epoch)
+	x_val, y_val = next(iter(val_loader))
+	x_val = x_val.to(DEVICE, memory_format=torch.channels_last).float().div_(255)
+	y_val = y_val.to(DEVICE)
+	x_test, y_test = next(iter(test_loader))
+	x_test = x_test.float().div_(255)
+
+	model = CNN().to(DEVICE, memory_format=torch.channels_last)  # NHWC lets cuDNN use Tensor Core conv kernels
+	if rank == 0:
+		print(f'\nModel:\n{model}\n')
+		plot_torch_model(model, (1, INPUT_H, INPUT_W), input_device=DEVICE)
 
 	loss_func = torch.nn.CrossEntropyLoss()
 
@@ -125,46 +176,68 @@ if __name__ == '__main__':
 	else:
 		# Train model
 
-		print('----- TRAINING -----\n')
+		if rank == 0:
+			print('----- TRAINING -----\n')
 
+		# DDP all-reduces gradients, so the replicas' weights stay in sync
+		train_model = DDP(model, device_ids=[local_rank], bucket_cap_mb=25) if distributed else model
+		if USE_COMPILE:
+			# Fixed batch/input shapes, so Inductor only needs to trace this once (plus once for the last partial batch)
+			train_model = torch.compile(train_model, mode='max-autotune', fullgraph=True)
 		optimiser = torch.optim.Adam(model.parameters(), lr=LEARNING_RATE)
+		scaler = torch.amp.GradScaler(DEVICE, enabled=USE_AMP)
 		early_stopping = EarlyStopping(patience=10, min_delta=0, mode='max')
 
 		for epoch in range(1, NUM_EPOCHS + 1):
-			progress_bar = tqdm(range(len(train_loader)), unit='batches', ascii=True)
+			progress_bar = tqdm(
+				total=len(train_loader), desc=f'Epoch {epoch}/{NUM_EPOCHS}', unit='batches', ascii=True,
+				mininterval=0.5, disable=rank != 0
+			)
+			if distributed:
+				train_loader.sampler.set_epoch(epoch)
 			model.train()
+			batch_losses = []
 
 			for x_train, y_train in train_loader:
 				progress_bar.update()
-				progress_bar.set_description(f'Epoch {epoch}/{NUM_EPOCHS}')
 
-				x_train = x_train.to(DEVICE)
-				y_train = y_train.to(DEVICE)
+				x_train = x_train.to(DEVICE, non_blocking=True, memory_format=torch.channels_last).float().div_(255)
+				y_train = y_train.to(DEVICE, non_blocking=True)
 
-				y_train_logits = model(x_train)
-				loss = loss_func(y_train_logits, y_train)
+				with torch.autocast(DEVICE, dtype=torch.float16, enabled=USE_AMP):
+					y_train_logits = train_model(x_train)
+					loss = loss_func(y_train_logits, y_train)
 
-				optimiser.zero_grad()
-				loss.backward()
-				optimiser.step()
+				optimiser.zero_grad(set_to_none=True)
+				scaler.scale(loss).backward()
+				scaler.step(optimiser)
+				scaler.update()
 
-				progress_bar.set_postfix_str(f'loss={loss.item():.4f}')
+				batch_losses.append(loss.detach())  # Calling .item() here would sync with the GPU every batch
 
 			model.eval()
-			x_val, y_val = next(iter(val_loader))
-			with torch.inference_mode():
-				y_val_logits = model(x_val.to(DEVICE)).cpu()
-			val_loss = loss_func(y_val_logits, y_val).item()
-			val_f1 = f1_score(y_val, y_val_logits.argmax(dim=1), average='weighted')
-			progress_bar.set_postfix_str(f'val_loss={val_loss:.4f}, val_F1={val_f1:.4f}')
+			with torch.inference_mode(), torch.autocast(DEVICE, dtype=torch.float16, enabled=USE_AMP):
+				y_val_logits = model(x_val)
+				val_loss = loss_func(y_val_logits, y_val)
+			val_f1 = weighted_f1_score(y_val, y_val_logits.argmax(dim=1), num_classes=4)
+			train_loss = torch.stack(batch_losses).mean().item()
+			val_loss = val_loss.item()
+			val_f1 = mean_over_ranks(val_f1.item())  # So every rank makes the same early stopping decision
+			progress_bar.set_postfix_str(f'loss={train_loss:.4f}, val_loss={val_loss:.4f}, val_F1={val_f1:.4f}')
 			progress_bar.close()
 
 			if early_stopping(val_f1, model.state_dict()):
-				print('Early stopping at epoch', epoch)
+				if rank == 0:
+					print('Early stopping at epoch', epoch)
 				break
 
 		model.load_state_dict(early_stopping.best_weights)  # Restore best weights
-		torch.save(model.state_dict(), './model.pth')
+		if rank == 0:
+			torch.save(model.state_dict(), './model.pth')
+
+	cleanup_distributed()
+	if rank != 0:
+		return
 
 	# Plot the model's learned filters, and corresponding feature maps of a sample image
 
@@ -178,8 +251,7 @@ if __name__ == '__main__':
 			save_path=f'./images/conv{idx}_filters.png'
 		)
 
-	x_val, _ = next(iter(val_loader))
-	layer_feature_maps = get_cnn_feature_maps(model, input_img=x_val[0].to(DEVICE))
+	layer_feature_maps = get_cnn_feature_maps(model, input_img=x_val[0])
 	for idx, (feature_map, padding, scale_factor) in enumerate(zip(layer_feature_maps, (10, 5), (0.75, 1)), start=1):
 		cols = idx * 8
 		rows = len(feature_map) // cols
@@ -194,9 +266,8 @@ if __name__ == '__main__':
 	print('\n----- TESTING -----\n')
 
 	model.eval()
-	x_test, y_test = next(iter(test_loader))
-	with torch.inference_mode():
-		y_test_logits = model(x_test.to(DEVICE)).cpu()
+	with torch.inference_mode(), torch.autocast(DEVICE, dtype=torch.float16, enabled=USE_AMP):
+		y_test_logits = model(x_test.to(DEVICE, memory_format=torch.channels_last)).float().cpu()
 
 	test_loss = loss_func(y_test_logits, y_test)
 	print('Test loss:', test_loss.item())
@@ -211,3 +282,8 @@ if __name__ == '__main__':
 		x_ticks_rotation=45,
 		horiz_alignment='right'
 	)
+
+
+if __name__ == '__main__':
+	# Single process: `python main.py`, multi-GPU: `torchrun --nproc_per_node=<num GPUs> main.py`
+	main()
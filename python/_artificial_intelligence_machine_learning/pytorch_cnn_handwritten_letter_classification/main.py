@@ -19,17 +19,26 @@ from tqdm import tqdm
 
 from _utils.custom_dataset import CustomDataset
 from _utils.early_stopping import EarlyStopping
+from _utils.metrics import weighted_f1_score
 from _utils.plotting import *
 from conv_net import CNN
 
 
 torch.manual_seed(1)
+torch.backends.cudnn.benchmark = True  # Input shape is fixed, so cuDNN's autotuned conv algorithms can be cached
+torch.set_float32_matmul_precision('high')  # Allow TF32 for any FP32 matmuls
 
 INPUT_SHAPE = (1, 28, 28)  # Colour channels, H, W
 BATCH_SIZE = 256
+EFFECTIVE_BATCH_SIZE = 256  # Set to a multiple of BATCH_SIZE to accumulate gradients over several batches
+assert EFFECTIVE_BATCH_SIZE >= BATCH_SIZE and EFFECTIVE_BATCH_SIZE % BATCH_SIZE == 0
+ACCUM_STEPS = EFFECTIVE_BATCH_SIZE // BATCH_SIZE
 NUM_EPOCHS = 50
 DRAWING_CELL_SIZE = 15
 DRAWING_SIZE = DRAWING_CELL_SIZE * 28
+DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
+USE_AMP = DEVICE == 'cuda'  # Mixed precision (FP16) for Tensor Core GPUs
+USE_COMPILE = DEVICE == 'cuda'  # The compile modes used here rely on CUDA graphs, and only repay compile time on GPU
 
 
 def load_data():
@@ -38,13 +47,12 @@ def load_data():
 	x, y = df.iloc[:, 1:].to_numpy(), df.iloc[:, 0]
 
 	# Reshape images, normalise to [0,1], and add channel dim
-	x = x.reshape((-1, 28, 28)) / 255
-	x = np.expand_dims(x, 1)
+	x = x.reshape((-1, 1, 28, 28)).astype(np.float32) / 255
 
 	label_encoder = LabelEncoder()
 	y = label_encoder.fit_transform(y)
 
-	x, y = torch.tensor(x).float(), torch.tensor(y).long()
+	x, y = torch.from_numpy(x), torch.from_numpy(y).long()  # y stays as class indices for CrossEntropyLoss
 
 	# Create train/validation/test sets (ratio 0.98:0.01:0.01)
 	x_train_val, x_test, y_train_val, y_test = train_test_split(
@@ -55,7 +63,11 @@ def load_data():
 	)
 
 	train_set = CustomDataset(x_train, y_train)
-	train_loader = DataLoader(train_set, batch_size=BATCH_SIZE, shuffle=False)
+	train_loader = DataLoader(
+		train_set, batch_size=BATCH_SIZE, shuffle=False, num_workers=4,
+		pin_memory=DEVICE == 'cuda', persistent_workers=True,
+		drop_last=True  # Keep batch shape static, so the compiled model isn't recompiled for the last batch
+	)
 
 	return train_loader, x_val, y_val, x_test, y_test
 
@@ -64,17 +76,21 @@ if __name__ == '__main__':
 	# Prepare data
 
 	train_loader, x_val, y_val, x_test, y_test = load_data()
+	# Copy to device once, not per prediction (y_test stays on the CPU for sklearn)
+	x_val = x_val.to(DEVICE, memory_format=torch.channels_last)
+	y_val = y_val.to(DEVICE)
+	x_test = x_test.to(DEVICE, memory_format=torch.channels_last)
 
 	# Define model
 
-	model = CNN().cpu()
+	model = CNN().to(DEVICE, memory_format=torch.channels_last)  # NHWC lets cuDNN use Tensor Core conv kernels
 	print(f'\nModel:\n{model}\n')
-	plot_torch_model(model, INPUT_SHAPE)
+	plot_torch_model(model, INPUT_SHAPE, input_device=DEVICE)
 
 	loss_func = torch.nn.CrossEntropyLoss()
 
 	if os.path.exists('./model.pth'):
-		model.load_state_dict(torch.load('./model.pth'))
+		model.load_state_dict(torch.load('./model.pth', map_location=DEVICE))
 	else:
 		# Plot some example images
 
@@ -87,31 +103,44 @@ if __name__ == '__main__':
 
 		print('----- TRAINING -----\n')
 
+		# Fuses kernels and replays CUDA graphs to cut per-op launch overhead during training/validation. Shares
+		# weights with the eager model, which is used for saving/loading, one-off inference and the feature map hooks.
+		compiled_model = torch.compile(model, mode='reduce-overhead', fullgraph=True) if USE_COMPILE else model
+
 		optimiser = torch.optim.Adam(model.parameters())  # LR = 1e-3
+		scaler = torch.amp.GradScaler(DEVICE, enabled=USE_AMP)
 		early_stopping = EarlyStopping(patience=5, min_delta=0, mode='max')
 
 		for epoch in range(1, NUM_EPOCHS + 1):
 			progress_bar = tqdm(range(len(train_loader)), unit='batches', ascii=True)
 			model.train()
 
-			for x_train, y_train in train_loader:
+			for batch_idx, (x_train, y_train) in enumerate(train_loader, start=1):
 				progress_bar.update()
 				progress_bar.set_description(f'Epoch {epoch}/{NUM_EPOCHS}')
 
-				y_train_logits = model(x_train)
-				loss = loss_func(y_train_logits, y_train)
+				x_train = x_train.to(DEVICE, non_blocking=True, memory_format=torch.channels_last)
+				y_train = y_train.to(DEVICE, non_blocking=True)
+
+				with torch.autocast(DEVICE, dtype=torch.float16, enabled=USE_AMP):
+					y_train_logits = compiled_model(x_train)
+					loss = loss_func(y_train_logits, y_train)
 
-				optimiser.zero_grad()
-				loss.backward()
-				optimiser.step()
+				scaler.scale(loss / ACCUM_STEPS).backward()  # Gradients are summed over ACCUM_STEPS batches
+
+				if batch_idx % ACCUM_STEPS == 0 or batch_idx == len(train_loader):
+					scaler.step(optimiser)
+					scaler.update()
+					optimiser.zero_grad(set_to_none=True)
 
 				progress_bar.set_postfix_str(f'loss={loss.item():.4f}')
 
 			model.eval()
-			with torch.inference_mode():
-				y_val_logits = model(x_val)
-			val_loss = loss_func(y_val_logits, y_val).item()
-			val_f1 = f1_score(y_val, y_val_logits.argmax(dim=1), average='weighted')
+			with torch.inference_mode(), torch.autocast(DEVICE, dtype=torch.float16, enabled=USE_AMP):
+				y_val_logits = compiled_model(x_val).float()
+			val_loss = loss_func(y_val_logits, y_val)
+			val_f1 = weighted_f1_score(y_val, y_val_logits.argmax(dim=1), num_classes=26)
+			val_loss, val_f1 = val_loss.item(), val_f1.item()
 			progress_bar.set_postfix_str(f'val_loss={val_loss:.4f}, val_F1={val_f1:.4f}')
 			progress_bar.close()
 
@@ -138,8 +167,8 @@ if __name__ == '__main__':
 	print('\n----- TESTING -----\n')
 
 	model.eval()
-	with torch.inference_mode():
-		y_test_logits = model(x_test)
+	with torch.inference_mode(), torch.autocast(DEVICE, dtype=torch.float16, enabled=USE_AMP):
+		y_test_logits = model(x_test).float().cpu()
 	test_pred = y_test_logits.argmax(dim=1)
 	test_loss = loss_func(y_test_logits, y_test)
 	print(f'Test loss: {test_loss.item()}\n')
@@ -151,16 +180,33 @@ if __name__ == '__main__':
 
 	# User draws a letter to predict
 
+	# Frozen TorchScript model for live predictions (fuses conv/bias/activation ops and skips Python dispatch per call).
+	# The device-agnostic scripted model is reused from disk unless model.pth is newer, and the (cheap, device-specific)
+	# optimisation is redone every run. Warmed up once so the JIT's first-call cost isn't paid mid-drawing.
+	if os.path.exists('./model_ts.pt') and os.path.getmtime('./model_ts.pt') >= os.path.getmtime('./model.pth'):
+		scripted_model = torch.jit.load('./model_ts.pt', map_location=DEVICE)
+	else:
+		scripted_model = torch.jit.script(model)
+		scripted_model.save('./model_ts.pt')
+	scripted_model = torch.jit.optimize_for_inference(scripted_model.eval())
+	with torch.inference_mode():
+		scripted_model(torch.zeros((1, *INPUT_SHAPE), device=DEVICE).to(memory_format=torch.channels_last))
+
 	pg.init()
 	pg.display.set_caption('Draw a letter!')
 	scene = pg.display.set_mode((DRAWING_SIZE, DRAWING_SIZE))
 	font = pg.font.SysFont('consolas', 16)
-	user_drawing_coords = np.zeros((0, 2))
-	model_input = torch.zeros(INPUT_SHAPE)
+	user_drawing_coords = []  # Converted to an array only when needed
+	drawing_img = np.zeros((28, 28), dtype=np.uint8)  # Source of truth for the drawing, made a tensor only to predict
+	canvas = pg.Surface((28, 28))  # Drawn at 28x28 then scaled up to the window
+	clock = pg.time.Clock()
+	num_coords_predicted = 0
 	drawing = True
 	left_btn_down = False
 
 	while drawing:
+		clock.tick(30)  # Predict at most ~30 times/sec, with all mouse events since the last frame processed at once
+
 		for event in pg.event.get():
 			match event.type:
 				case pg.QUIT:
@@ -169,45 +215,49 @@ if __name__ == '__main__':
 				case pg.MOUSEBUTTONDOWN:
 					if event.button == 1:
 						left_btn_down = True
-						x, y = event.pos
-						user_drawing_coords = np.append(user_drawing_coords, [[x, y]], axis=0)
+						user_drawing_coords.append(event.pos)
 				case pg.MOUSEMOTION:
 					if left_btn_down:
-						x, y = event.pos
-						user_drawing_coords = np.append(user_drawing_coords, [[x, y]], axis=0)
+						user_drawing_coords.append(event.pos)
 				case pg.MOUSEBUTTONUP:
 					if event.button == 1:
 						left_btn_down = False
 
-		if not left_btn_down:
-			continue
+		if not left_btn_down or len(user_drawing_coords) == num_coords_predicted:
+			continue  # Nothing new drawn since the last prediction
+		num_coords_predicted = len(user_drawing_coords)
 
 		# Map coords to range [0,27]
-		pixelated_coords = user_drawing_coords * 27 / DRAWING_SIZE
-		pixelated_coords = np.unique(pixelated_coords.round(), axis=0).astype(int)  # Keep only unique coords
-		pixelated_coords = np.clip(pixelated_coords, 0, 27)
+		pixelated_coords = np.asarray(user_drawing_coords, dtype=np.float32) * 27 / DRAWING_SIZE
+		pixelated_coords = np.clip(pixelated_coords.round().astype(int), 0, 27)
+
+		# Keep only unique coords (via a 28x28 mask, rather than sorting rows with np.unique)
+		drawn_mask = np.zeros((28, 28), dtype=bool)
+		drawn_mask[pixelated_coords[:, 1], pixelated_coords[:, 0]] = True
+		ys, xs = drawn_mask.nonzero()
+		pixelated_coords = np.column_stack((xs, ys))
 
 		# Set these pixels as bright
-		model_input[:, pixelated_coords[:, 1], pixelated_coords[:, 0]] = 1
+		drawing_img[pixelated_coords[:, 1], pixelated_coords[:, 0]] = 255
 
-		# Add some edge blurring
-		for x, y in pixelated_coords:
-			for dx, dy in [(0, -1), (1, 0), (0, 1), (-1, 0)]:
-				if 0 <= x + dx <= 27 and 0 <= y + dy <= 27 and model_input[:, y + dy, x + dx] == 0:
-					model_input[:, y + dy, x + dx] = np.random.uniform(0.33, 1)
+		# Add some edge blurring (random brightness for any dark, in-bounds 4-neighbours of the drawn pixels)
+		neighbours = pixelated_coords[:, None, :] + np.array([[0, -1], [1, 0], [0, 1], [-1, 0]])
+		neighbours = neighbours.reshape(-1, 2)
+		neighbours = neighbours[((neighbours >= 0) & (neighbours <= 27)).all(axis=1)]
+		xs, ys = neighbours[:, 0], neighbours[:, 1]
+		dark = drawing_img[ys, xs] == 0
+		drawing_img[ys[dark], xs[dark]] = np.random.randint(84, 256, size=dark.sum())  # 84 = 0.33 * 255
 
+		model_input = torch.from_numpy(drawing_img).float().div_(255).unsqueeze(dim=0)  # -> (1, 28, 28) in [0,1]
 		with torch.inference_mode():
-			pred_logits = model(model_input.unsqueeze(dim=0))
+			# Fixed shape (1, 1, 28, 28)
+			drawing_input = model_input.unsqueeze(dim=0).to(DEVICE, memory_format=torch.channels_last)
+			pred_logits = scripted_model(drawing_input).cpu()
 		pred_probs = torch.softmax(pred_logits, dim=-1)
 
-		for y in range(28):
-			for x in range(28):
-				colour = round(255 * model_input[0, y, x].item())
-				pg.draw.rect(
-					scene,
-					(colour, colour, colour),
-					pg.Rect(x * DRAWING_CELL_SIZE, y * DRAWING_CELL_SIZE, DRAWING_CELL_SIZE, DRAWING_CELL_SIZE)
-				)
+		# Draw the canvas in one blit (surfarray is indexed (x, y), so transpose)
+		pg.surfarray.blit_array(canvas, np.stack([drawing_img.T] * 3, axis=-1))
+		scene.blit(pg.transform.scale(canvas, (DRAWING_SIZE, DRAWING_SIZE)), (0, 0))
 
 		pred_letter = chr(65 + pred_probs.argmax().item())
 		pred_lbl = font.render(f'{pred_letter} ({(100 * pred_probs.max()):.1f}% sure)', True, 'green')
@@ -218,7 +268,8 @@ if __name__ == '__main__':
 	# Plot feature maps of user-drawn letter
 
 	# Plot feature maps for user-drawn digit
-	layer_feature_maps = get_cnn_feature_maps(model, input_img=model_input)
+	model_input = torch.from_numpy(drawing_img).float().div_(255).unsqueeze(dim=0)
+	layer_feature_maps = get_cnn_feature_maps(model, input_img=model_input.to(DEVICE))
 	for idx, (feature_map, padding, scale_factor) in enumerate(zip(layer_feature_maps, (15, 10), (3, 6)), start=1):
 		cols = 8
 		rows = len(feature_map) // cols
@@ -13,11 +13,15 @@ from sklearn.metrics import f1_score
 from sklearn.model_selection import train_test_split
 from tensorflow.keras.datasets import mnist  # Faster to use TF than torchvision
 import torch
-from torch.utils.data import DataLoader
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.utils.data import DataLoader, DistributedSampler
 from tqdm import tqdm
 
 from _utils.custom_dataset import CustomDataset
+from _utils.distributed import cleanup_distributed, init_distributed, mean_over_ranks
 from _utils.early_stopping import EarlyStopping
+from _utils.metrics import weighted_f1_score
 from _utils.plotting import *
 from conv_net import CNN
 
@@ -30,18 +34,23 @@ BATCH_SIZE = 256
 NUM_EPOCHS = 50
 DRAWING_CELL_SIZE = 15
 DRAWING_SIZE = DRAWING_CELL_SIZE * 28
+DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
+USE_AMP = DEVICE == 'cuda'  # Mixed precision (FP16) for Tensor Core GPUs
+USE_COMPILE = DEVICE == 'cuda'  # The compile modes used here rely on CUDA graphs, and only repay compile time on GPU
 
 
 def load_data():
 	(x_train, y_train), (x_test, y_test) = mnist.load_data()
 
-	# Normalise images to [0,1] and add channel dim
-	x = np.concatenate([x_train, x_test], axis=0, dtype=float) / 255
+	# Normalise images to [0,1] (in float32, so no intermediate float64 copy) and add channel dim
+	x = np.concatenate([x_train, x_test], axis=0, dtype=np.float32)
+	x /= 255
 	x = np.expand_dims(x, 1)
 
-	y = np.concatenate([y_train, y_test])
+	# Keep y as class indices (CrossEntropyLoss doesn't need one-hot targets)
+	y = np.concatenate([y_train, y_test], dtype=np.int64)
 
-	x, y = torch.tensor(x).float(), torch.tensor(y).long()
+	x, y = torch.from_numpy(x), torch.from_numpy(y)  # Zero-copy
 
 	# Create train/validation/test sets (ratio 0.96:0.02:0.02)
 	x_train_val, x_test, y_train_val, y_test = train_test_split(
@@ -52,72 +61,115 @@ def load_data():
 	)
 
 	train_set = CustomDataset(x_train, y_train)
-	train_loader = DataLoader(train_set, batch_size=BATCH_SIZE, shuffle=False)
+	sampler = DistributedSampler(train_set, shuffle=False) if dist.is_initialized() else None
+	train_loader = DataLoader(
+		train_set, batch_size=BATCH_SIZE, sampler=sampler, num_workers=os.cpu_count(),
+		pin_memory=DEVICE == 'cuda', persistent_workers=True, prefetch_factor=4
+	)
 
 	return train_loader, x_val, y_val, x_test, y_test
 
 
-if __name__ == '__main__':
+def predict_in_batches(model, x):
+	# Forward pass in chunks of BATCH_SIZE (bounds peak memory vs. 1 giant batch), collecting into 1 logits tensor
+
+	with torch.inference_mode(), torch.autocast(DEVICE, dtype=torch.float16, enabled=USE_AMP):
+		logits = torch.empty((len(x), 10), device=DEVICE)
+		for x_batch, logits_batch in zip(x.split(BATCH_SIZE), logits.split(BATCH_SIZE)):
+			logits_batch.copy_(model(x_batch.to(DEVICE, non_blocking=True, memory_format=torch.channels_last)))
+
+	return logits
+
+
+def main():
+	rank, local_rank, world_size = init_distributed(seed=1)
+	distributed = world_size > 1
+
 	# Prepare data
 
 	train_loader, x_val, y_val, x_test, y_test = load_data()
+	x_val, y_val = x_val.to(DEVICE, memory_format=torch.channels_last), y_val.to(DEVICE)  # Used every epoch
 
 	# Define model
 
-	model = CNN().cpu()
-	print(f'\nModel:\n{model}\n')
-	plot_torch_model(model, INPUT_SHAPE)
+	model = CNN().to(DEVICE, memory_format=torch.channels_last)  # NHWC lets cuDNN use Tensor Core conv kernels
+	if rank == 0:
+		print(f'\nModel:\n{model}\n')
+		plot_torch_model(model, INPUT_SHAPE, input_device=DEVICE)
 
 	loss_func = torch.nn.CrossEntropyLoss()
 
 	if os.path.exists('./model.pth'):
-		model.load_state_dict(torch.load('./model.pth'))
+		model.load_state_dict(torch.load('./model.pth', map_location=DEVICE))
 	else:
-		# Plot some example images
+		if rank == 0:
+			# Plot some example images
 
-		plot_image_grid(
-			x_val[:32], rows=4, cols=8, padding=5, scale_factor=2,
-			title='Data samples', save_path='./images/data_samples.png'
-		)
+			plot_image_grid(
+				x_val[:32], rows=4, cols=8, padding=5, scale_factor=2,
+				title='Data samples', save_path='./images/data_samples.png'
+			)
 
-		# Train model
+			print('----- TRAINING -----\n')
 
-		print('----- TRAINING -----\n')
+		# Train model
 
+		# DDP all-reduces gradients, so the replicas' weights stay in sync
+		train_model = DDP(model, device_ids=[local_rank], bucket_cap_mb=25) if distributed else model
+		if USE_COMPILE:
+			# Fixed batch/input shapes, so Inductor only needs to trace this once (plus once for the last partial batch)
+			train_model = torch.compile(train_model, mode='max-autotune', fullgraph=True)
 		optimiser = torch.optim.Adam(model.parameters())  # LR = 1e-3
+		scaler = torch.amp.GradScaler(DEVICE, enabled=USE_AMP)
 		early_stopping = EarlyStopping(patience=5, min_delta=0, mode='max')
 
 		for epoch in range(1, NUM_EPOCHS + 1):
-			progress_bar = tqdm(range(len(train_loader)), unit='batches', ascii=True)
+			progress_bar = tqdm(range(len(train_loader)), unit='batches', ascii=True, disable=rank != 0)
+			if distributed:
+				train_loader.sampler.set_epoch(epoch)
 			model.train()
+			batch_losses = []
 
 			for x_train, y_train in train_loader:
 				progress_bar.update()
 				progress_bar.set_description(f'Epoch {epoch}/{NUM_EPOCHS}')
 
-				y_train_logits = model(x_train)
-				loss = loss_func(y_train_logits, y_train)
+				x_train = x_train.to(DEVICE, non_blocking=True, memory_format=torch.channels_last)
+				y_train = y_train.to(DEVICE, non_blocking=True)
+
+				with torch.autocast(DEVICE, dtype=torch.float16, enabled=USE_AMP):
+					y_train_logits = train_model(x_train)
+					loss = loss_func(y_train_logits, y_train)
 
-				optimiser.zero_grad()
-				loss.backward()
-				optimiser.step()
+				optimiser.zero_grad(set_to_none=True)
+				scaler.scale(loss).backward()
+				scaler.step(optimiser)
+				scaler.update()
 
-				progress_bar.set_postfix_str(f'loss={loss.item():.4f}')
+				batch_losses.append(loss.detach())  # Calling .item() here would sync with the GPU every batch
 
 			model.eval()
-			with torch.inference_mode():
-				y_val_logits = model(x_val)
-			val_loss = loss_func(y_val_logits, y_val).item()
-			val_f1 = f1_score(y_val, y_val_logits.argmax(dim=1), average='weighted')
-			progress_bar.set_postfix_str(f'val_loss={val_loss:.4f}, val_F1={val_f1:.4f}')
+			y_val_logits = predict_in_batches(model, x_val)
+			val_loss = loss_func(y_val_logits, y_val)
+			val_f1 = weighted_f1_score(y_val, y_val_logits.argmax(dim=1), num_classes=10)
+			train_loss = torch.stack(batch_losses).mean().item()
+			val_loss = val_loss.item()
+			val_f1 = mean_over_ranks(val_f1.item())  # So every rank makes the same early stopping decision
+			progress_bar.set_postfix_str(f'loss={train_loss:.4f}, val_loss={val_loss:.4f}, val_F1={val_f1:.4f}')
 			progress_bar.close()
 
 			if early_stopping(val_f1, model.state_dict()):
-				print('Early stopping at epoch', epoch)
+				if rank == 0:
+					print('Early stopping at epoch', epoch)
 				break
 
 		model.load_state_dict(early_stopping.best_weights)  # Restore best weights
-		torch.save(model.state_dict(), './model.pth')
+		if rank == 0:
+			torch.save(model.state_dict(), './model.pth')
+
+	cleanup_distributed()
+	if rank != 0:
+		return
 
 	# Plot the model's learned filters
 	layer_filters = get_cnn_learned_filters(model)
@@ -135,8 +187,7 @@ if __name__ == '__main__':
 	print('\n----- TESTING -----\n')
 
 	model.eval()
-	with torch.inference_mode():
-		y_test_logits = model(x_test)
+	y_test_logits = predict_in_batches(model, x_test).cpu()
 	test_pred = y_test_logits.argmax(dim=1)
 	test_loss = loss_func(y_test_logits, y_test)
 	print(f'Test loss: {test_loss.item()}\n')
@@ -147,16 +198,29 @@ if __name__ == '__main__':
 
 	# User draws a digit to predict
 
+	device_input = torch.zeros((1, *INPUT_SHAPE), device=DEVICE)  # Reused for every prediction (no reallocation)
+	if USE_COMPILE:
+		# Specialised to 1 sample. Compiled and autotuned now, rather than freezing the window on the first stroke.
+		drawing_model = torch.compile(model, mode='max-autotune', fullgraph=True, dynamic=False)
+		with torch.inference_mode(), torch.autocast(DEVICE, dtype=torch.float16, enabled=USE_AMP):
+			drawing_model(device_input)
+	else:
+		drawing_model = model
+
 	pg.init()
 	pg.display.set_caption('Draw a digit!')
 	scene = pg.display.set_mode((DRAWING_SIZE, DRAWING_SIZE))
 	font = pg.font.SysFont('consolas', 16)
-	user_drawing_coords = np.zeros((0, 2))
+	user_drawing_coords = np.empty((1024, 2), dtype=np.int16)  # Doubled in size whenever it fills up
+	num_coords = 0
 	model_input = torch.zeros(INPUT_SHAPE)
+	clock = pg.time.Clock()
 	drawing = True
 	left_btn_down = False
 
 	while drawing:
+		clock.tick(60)  # Cap the redraw rate at ~16ms/frame
+
 		for event in pg.event.get():
 			match event.type:
 				case pg.QUIT:
@@ -165,35 +229,37 @@ if __name__ == '__main__':
 				case pg.MOUSEBUTTONDOWN:
 					if event.button == 1:
 						left_btn_down = True
-						x, y = event.pos
-						user_drawing_coords = np.append(user_drawing_coords, [[x, y]], axis=0)
-				case pg.MOUSEMOTION:
-					if left_btn_down:
-						x, y = event.pos
-						user_drawing_coords = np.append(user_drawing_coords, [[x, y]], axis=0)
 				case pg.MOUSEBUTTONUP:
 					if event.button == 1:
 						left_btn_down = False
 
+			if left_btn_down and event.type in (pg.MOUSEBUTTONDOWN, pg.MOUSEMOTION):
+				if num_coords == len(user_drawing_coords):
+					user_drawing_coords = np.resize(user_drawing_coords, (2 * num_coords, 2))
+				user_drawing_coords[num_coords] = event.pos
+				num_coords += 1
+
 		if not left_btn_down:
 			continue
 
-		# Map coords to range [0,27]
-		pixelated_coords = user_drawing_coords * 27 / DRAWING_SIZE
-		pixelated_coords = np.unique(pixelated_coords.round(), axis=0).astype(int)  # Keep only unique coords
+		# Map coords to range [0,27], and histogram them into the 28x28 grid to get the unique drawn pixels
+		pixelated_coords = (user_drawing_coords[:num_coords] * 27 / DRAWING_SIZE).round().astype(int)
 		pixelated_coords = np.clip(pixelated_coords, 0, 27)
+		pixel_counts = np.bincount(pixelated_coords[:, 1] * 28 + pixelated_coords[:, 0], minlength=28 * 28)
+		drawn_pixels = pixel_counts.reshape(28, 28) > 0
 
 		# Set these pixels as bright
-		model_input[:, pixelated_coords[:, 1], pixelated_coords[:, 0]] = 1
+		model_input[0, torch.from_numpy(drawn_pixels)] = 1
 
 		# Add some edge blurring
-		for x, y in pixelated_coords:
+		for y, x in zip(*drawn_pixels.nonzero()):
 			for dx, dy in [(0, -1), (1, 0), (0, 1), (-1, 0)]:
 				if 0 <= x + dx <= 27 and 0 <= y + dy <= 27 and model_input[:, y + dy, x + dx] == 0:
 					model_input[:, y + dy, x + dx] = np.random.uniform(0.33, 1)
 
-		with torch.inference_mode():
-			pred_logits = model(model_input.unsqueeze(dim=0))
+		device_input.copy_(model_input)  # Broadcasts (C, H, W) -> (1, C, H, W)
+		with torch.inference_mode(), torch.autocast(DEVICE, dtype=torch.float16, enabled=USE_AMP):
+			pred_logits = drawing_model(device_input).float().cpu()
 		pred_probs = torch.softmax(pred_logits, dim=-1)
 
 		for y in range(28):
@@ -211,7 +277,7 @@ if __name__ == '__main__':
 		pg.display.update()
 
 	# Plot feature maps for user-drawn digit
-	layer_feature_maps = get_cnn_feature_maps(model, input_img=model_input)
+	layer_feature_maps = get_cnn_feature_maps(model, input_img=device_input[0])
 	for idx, (feature_map, padding, scale_factor) in enumerate(zip(layer_feature_maps, (15, 10), (3, 6)), start=1):
 		cols = 8
 		rows = len(feature_map) // cols
@@ -220,3 +286,8 @@ if __name__ == '__main__':
 			title=f'Feature map of conv layer {idx}/{len(layer_feature_maps)} (user-drawn digit)',
 			save_path=f'./images/conv{idx}_feature_map.png'
 		)
+
+
+if __name__ == '__main__':
+	# Single process: `python main.py`, multi-GPU: `torchrun --nproc_per_node=<num GPUs> main.py`
+	main()
@@ -5,16 +5,20 @@ Author: Sam Barba
 Created 01/07/2023
 """
 
+from concurrent.futures import ThreadPoolExecutor
 import glob
 import os
 
 from PIL import Image
 import torch
-from torch.utils.data import DataLoader
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.utils.data import DataLoader, DistributedSampler
 from torchvision import transforms
 from tqdm import tqdm
 
 from _utils.custom_dataset import CustomDataset
+from _utils.distributed import cleanup_distributed, init_distributed, mean_over_ranks
 from _utils.early_stopping import EarlyStopping
 from _utils.plotting import plot_torch_model, plot_image_grid
 from models import Generator, Discriminator
@@ -32,6 +36,7 @@ BATCH_SIZE = 128
 LEARNING_RATE = 1e-4
 OPTIM_BETAS = (0.5, 0.999)
 NUM_EPOCHS = 50
+PREVIEW_INTERVAL = 100  # Plot generation progress every this many iterations (and at the end of each epoch)
 DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
 
 
@@ -49,28 +54,46 @@ def create_train_loader():
 	]
 
 	dataset = CustomDataset(x)
-	train_loader = DataLoader(dataset, batch_size=BATCH_SIZE, shuffle=True)
+	sampler = DistributedSampler(dataset) if dist.is_initialized() else None
+	train_loader = DataLoader(
+		dataset, batch_size=BATCH_SIZE, shuffle=sampler is None, sampler=sampler, num_workers=os.cpu_count(),
+		pin_memory=DEVICE == 'cuda', persistent_workers=True, prefetch_factor=4
+	)
 
 	return train_loader
 
 
-if __name__ == '__main__':
-	gen_model = Generator(latent_dim=GEN_LATENT_DIM).to(DEVICE)
-	disc_model = Discriminator(noise_strength=DISC_NOISE_STRENGTH).to(DEVICE)
+def main():
+	rank, local_rank, world_size = init_distributed(seed=1)
+	distributed = world_size > 1
 
-	print(f'\nGenerator model:\n\n{gen_model}')
-	print(f'\nDiscriminator model:\n\n{disc_model}')
-	plot_torch_model(
-		gen_model, (GEN_LATENT_DIM, 1, 1), input_device=DEVICE, out_file='./images/generator_architecture'
-	)
-	plot_torch_model(
-		disc_model, (3, IMG_SIZE, IMG_SIZE), input_device=DEVICE, out_file='./images/discriminator_architecture'
-	)
+	# NHWC (channels last) lets cuDNN use Tensor Core conv kernels
+	gen_model = Generator(latent_dim=GEN_LATENT_DIM).to(DEVICE, memory_format=torch.channels_last)
+	disc_model = Discriminator(noise_strength=DISC_NOISE_STRENGTH).to(DEVICE, memory_format=torch.channels_last)
+
+	if rank == 0:
+		print(f'\nGenerator model:\n\n{gen_model}')
+		print(f'\nDiscriminator model:\n\n{disc_model}')
+		plot_torch_model(
+			gen_model, (GEN_LATENT_DIM, 1, 1), input_device=DEVICE, out_file='./images/generator_architecture'
+		)
+		plot_torch_model(
+			disc_model, (3, IMG_SIZE, IMG_SIZE), input_device=DEVICE, out_file='./images/discriminator_architecture'
+		)
 
 	if os.path.exists('./gen_model.pth'):
 		gen_model.load_state_dict(torch.load('./gen_model.pth', map_location=DEVICE))
 	else:
-		print('\n----- TRAINING -----\n')
+		if rank == 0:
+			print('\n----- TRAINING -----\n')
+
+		# Wrap each model separately so their gradient all-reduces overlap with backward. BatchNorm buffers aren't
+		# broadcast, as that modifies them in-place between the discriminator's forward passes.
+		if distributed:
+			train_gen_model = DDP(gen_model, device_ids=[local_rank], bucket_cap_mb=25, broadcast_buffers=False)
+			train_disc_model = DDP(disc_model, device_ids=[local_rank], bucket_cap_mb=25, broadcast_buffers=False)
+		else:
+			train_gen_model, train_disc_model = gen_model, disc_model
 
 		fixed_noise = torch.randn(24, GEN_LATENT_DIM, 1, 1, device=DEVICE)
 		train_loader = create_train_loader()
@@ -78,80 +101,99 @@ if __name__ == '__main__':
 		gen_optimiser = torch.optim.Adam(gen_model.parameters(), lr=LEARNING_RATE, betas=OPTIM_BETAS)
 		disc_optimiser = torch.optim.Adam(disc_model.parameters(), lr=LEARNING_RATE, betas=OPTIM_BETAS)
 		early_stopping = EarlyStopping(patience=5, min_delta=0, mode='min')
-
-		gen_model.eval()
-		with torch.inference_mode():
-			fake_images_test = gen_model(fixed_noise)
-		plot_image_grid(
-			fake_images_test, rows=4, cols=6, padding=4, scale_factor=1.5, scale_interpolation='cubic',
-			background_rgb=(0, 0, 0), title_rgb=(255, 255, 255),
-			title='Start', save_path='./images/0_start.png',
-			show=False
-		)
+		preview_executor = ThreadPoolExecutor(max_workers=1)
+
+		if rank == 0:
+			gen_model.eval()
+			with torch.inference_mode():
+				fake_images_test = gen_model(fixed_noise)
+			plot_image_grid(
+				fake_images_test, rows=4, cols=6, padding=4, scale_factor=1.5, scale_interpolation='cubic',
+				background_rgb=(0, 0, 0), title_rgb=(255, 255, 255),
+				title='Start', save_path='./images/0_start.png',
+				show=False
+			)
 
 		for epoch in range(1, NUM_EPOCHS + 1):
-			progress_bar = tqdm(range(len(train_loader)), unit='batches', ascii=True)
+			progress_bar = tqdm(
+				total=len(train_loader), desc=f'Epoch {epoch}/{NUM_EPOCHS}', unit='batches', ascii=True,
+				mininterval=0.5, disable=rank != 0
+			)
+			if distributed:
+				train_loader.sampler.set_epoch(epoch)
 			total_gen_loss = 0
 
 			for batch_idx, img_batch in enumerate(train_loader, start=1):
 				progress_bar.update()
-				progress_bar.set_description(f'Epoch {epoch}/{NUM_EPOCHS}')
+
+				img_batch = img_batch.to(DEVICE, non_blocking=True, memory_format=torch.channels_last)
 
 				gen_model.train()
 				noise = torch.randn(len(img_batch), GEN_LATENT_DIM, 1, 1, device=DEVICE)
-				fake = gen_model(noise)
+				fake = train_gen_model(noise).contiguous(memory_format=torch.channels_last)
 
 				# Train discriminator
 
-				disc_real = disc_model(img_batch.to(DEVICE))
+				disc_real = train_disc_model(img_batch)
 				disc_real_loss = loss_func(disc_real, torch.ones_like(disc_real))
-				disc_fake = disc_model(fake.detach())
+				disc_fake = train_disc_model(fake.detach())
 				disc_fake_loss = loss_func(disc_fake, torch.zeros_like(disc_fake))
 				disc_loss = (disc_real_loss + disc_fake_loss) / 2
 
-				disc_optimiser.zero_grad()
+				disc_optimiser.zero_grad(set_to_none=True)
 				disc_loss.backward()
 				disc_optimiser.step()
 
 				# Train generator
 
-				disc_fake = disc_model(fake)
+				disc_fake = train_disc_model(fake)
 				gen_loss = loss_func(disc_fake, torch.ones_like(disc_fake))
 				total_gen_loss += gen_loss.item()
 
-				gen_optimiser.zero_grad()
+				gen_optimiser.zero_grad(set_to_none=True)
 				gen_loss.backward()
 				gen_optimiser.step()
 
-				progress_bar.set_postfix_str(
-					f'disc_real_loss={disc_real_loss.item():.4f}, '
-					f'disc_fake_loss={disc_fake_loss.item():.4f}, '
-					f'gen_loss={gen_loss.item():.4f}'
-				)
-
-				# Plot generation progress
-
-				gen_model.eval()
-				with torch.inference_mode():
-					fake_images_test = gen_model(fixed_noise)
-				plot_image_grid(
-					fake_images_test, rows=4, cols=6, padding=4, scale_factor=1.5, scale_interpolation='cubic',
-					background_rgb=(0, 0, 0), title_rgb=(255, 255, 255),
-					title=f'Epoch {epoch}/{NUM_EPOCHS}, iteration {batch_idx}/{len(train_loader)}',
-					save_path=f'./images/ep_{epoch:03}_iter_{batch_idx:03}.png',
-					show=False
-				)
-
-			mean_gen_loss = total_gen_loss / len(train_loader)
+				if batch_idx % 20 == 0:
+					progress_bar.set_postfix_str(
+						f'disc_real_loss={disc_real_loss.item():.4f}, '
+						f'disc_fake_loss={disc_fake_loss.item():.4f}, '
+						f'gen_loss={gen_loss.item():.4f}'
+					)
+
+				# Plot generation progress (rendered and saved in the background, so training doesn't wait on it)
+
+				if rank == 0 and (batch_idx % PREVIEW_INTERVAL == 0 or batch_idx == len(train_loader)):
+					gen_model.eval()
+					with torch.inference_mode():
+						fake_images_test = gen_model(fixed_noise).cpu()
+					preview_executor.submit(
+						plot_image_grid,
+						fake_images_test, rows=4, cols=6, padding=4, scale_factor=1.5, scale_interpolation='cubic',
+						background_rgb=(0, 0, 0), title_rgb=(255, 255, 255),
+						title=f'Epoch {epoch}/{NUM_EPOCHS}, iteration {batch_idx}/{len(train_loader)}',
+						save_path=f'./images/ep_{epoch:03}_iter_{batch_idx:03}.png',
+						show=False
+					)
+
+			# Averaged over all ranks' shards, so every rank makes the same early stopping decision
+			mean_gen_loss = mean_over_ranks(total_gen_loss / len(train_loader))
 			progress_bar.set_postfix_str(f'mean_gen_loss={mean_gen_loss:.4f}')
 			progress_bar.close()
 
 			if early_stopping(mean_gen_loss, gen_model.state_dict()):
-				print('Early stopping at epoch', epoch)
+				if rank == 0:
+					print('Early stopping at epoch', epoch)
 				break
 
+		preview_executor.shutdown()  # Wait for any pending preview images to be saved
 		gen_model.load_state_dict(early_stopping.best_weights)  # Restore best weights
-		torch.save(gen_model.state_dict(), './gen_model.pth')
+		if rank == 0:
+			torch.save(gen_model.state_dict(), './gen_model.pth')
+
+	cleanup_distributed()
+	if rank != 0:
+		return
 
 	# Test generator on a random noise vector
 
@@ -179,3 +221,8 @@ if __name__ == '__main__':
 	# 		save_path=f'./images/{t:.2f}.png',
 	# 		show=False
 	# 	)
+
+
+if __name__ == '__main__':
+	# Single process: `python main.py`, multi-GPU: `torchrun --nproc_per_node=<num GPUs> main.py`
+	main()
@@ -23,6 +23,8 @@ from _utils.plotting import *
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'  # Reduce tensorflow log spam
 tf.random.set_seed(1)
+if tf.config.list_physical_devices('GPU'):
+	tf.keras.mixed_precision.set_global_policy('mixed_float16')  # FP16 compute (Tensor Cores), FP32 weights
 
 INPUT_SHAPE = (28, 28, 1)  # H, W, colour channels
 BATCH_SIZE = 256
@@ -35,12 +37,11 @@ def load_data():
 	(x_train, y_train), (x_test, y_test) = mnist.load_data()
 
 	# Normalise images to [0,1] and correct shape
-	x = np.concatenate([x_train, x_test], axis=0).astype(float) / 255
+	x = np.concatenate([x_train, x_test], axis=0).astype(np.float32) / 255
 	x = np.reshape(x, (len(x), *INPUT_SHAPE))
 
-	# One-hot encode y
-	y = np.concatenate([y_train, y_test])
-	y = np.eye(10)[y]  # 10 classes (0-9)
+	# Keep y as class indices (0-9), used with sparse categorical cross-entropy (no one-hot matrix needed)
+	y = np.concatenate([y_train, y_test]).astype(np.int32)
 
 	# Create train/validation/test sets (ratio 0.96:0.02:0.02)
 	x_train_val, x_test, y_train_val, y_test = train_test_split(x, y, train_size=0.98, stratify=y, random_state=1)
@@ -65,12 +66,12 @@ def build_model():
 			Dropout(0.5),
 			Dense(64),
 			LeakyReLU(alpha=1e-2),
-			Dense(10, activation='softmax')
+			Dense(10, activation='softmax', dtype='float32')  # Keep softmax in FP32 for numerical stability
 		],
 		name='digit_recognition_model'
 	)
 
-	model.compile(loss='categorical_crossentropy', optimizer='adam', metrics=['accuracy'])  # LR = 1e-3
+	model.compile(loss='sparse_categorical_crossentropy', optimizer='adam', metrics=['accuracy'])  # LR = 1e-3
 	model.build(input_shape=INPUT_SHAPE)
 
 	return model
@@ -82,7 +83,9 @@ if __name__ == '__main__':
 	x_train, y_train, x_val, y_val, x_test, y_test = load_data()
 
 	if os.path.exists('./model.h5'):
-		model = load_model('./model.h5')
+		# The saved model was compiled with one-hot (categorical) loss and metrics, so recompile for index labels
+		model = load_model('./model.h5', compile=False)
+		model.compile(loss='sparse_categorical_crossentropy', optimizer='adam', metrics=['accuracy'])
 	else:
 		# Plot some example images
 
@@ -91,9 +94,11 @@ if __name__ == '__main__':
 			title='Data samples', save_path='./images/data_samples.png'
 		)
 
-		# Define model
+		# Define model (replicated across all visible GPUs)
 
-		model = build_model()
+		strategy = tf.distribute.MirroredStrategy()
+		with strategy.scope():
+			model = build_model()
 		model.summary()
 		plot_model(
 			model,
@@ -108,6 +113,18 @@ if __name__ == '__main__':
 
 		print('\n----- TRAINING -----\n')
 
+		# Cached, shuffled, prefetched input pipeline (overlaps host->device copies with training)
+		global_batch_size = BATCH_SIZE * strategy.num_replicas_in_sync
+		train_ds = tf.data.Dataset.from_tensor_slices((x_train, y_train)) \
+			.cache() \
+			.shuffle(10_000) \
+			.batch(global_batch_size) \
+			.prefetch(tf.data.AUTOTUNE)
+		val_ds = tf.data.Dataset.from_tensor_slices((x_val, y_val)) \
+			.batch(global_batch_size) \
+			.cache() \
+			.prefetch(tf.data.AUTOTUNE)
+
 		early_stopping = tf.keras.callbacks.EarlyStopping(
 			patience=5,
 			restore_best_weights=True,
@@ -116,10 +133,9 @@ if __name__ == '__main__':
 		)
 
 		history = model.fit(
-			x_train, y_train,
+			train_ds,
 			epochs=NUM_EPOCHS,
-			batch_size=BATCH_SIZE,
-			validation_data=(x_val, y_val),
+			validation_data=val_ds,
 			callbacks=[early_stopping],
 			verbose=1
 		)
@@ -149,8 +165,8 @@ if __name__ == '__main__':
 
 	# Confusion matrix
 	test_pred = model.predict(x_test, verbose=0).argmax(axis=1)
-	f1 = f1_score(y_test.argmax(axis=1), test_pred, average='weighted')
-	plot_confusion_matrix(y_test.argmax(axis=1), test_pred, None, f'Test confusion matrix\n(F1 score: {f1:.3f})')
+	f1 = f1_score(y_test, test_pred, average='weighted')
+	plot_confusion_matrix(y_test, test_pred, None, f'Test confusion matrix\n(F1 score: {f1:.3f})')
 
 	# Plot the model's learned filters
 	layer_filters = get_cnn_learned_filters(model, model_type='tensorflow')
@@ -169,12 +185,17 @@ if __name__ == '__main__':
 	pg.display.set_caption('Draw a digit!')
 	scene = pg.display.set_mode((DRAWING_SIZE, DRAWING_SIZE))
 	font = pg.font.SysFont('consolas', 16)
-	user_drawing_coords = np.zeros((0, 2))
-	model_input = np.zeros(INPUT_SHAPE)
+	user_drawing_coords = []  # Converted to an array only when needed
+	model_input = np.zeros(INPUT_SHAPE, dtype=np.float32)
+	canvas = pg.Surface((28, 28))  # Drawn at 28x28 then scaled up to the window
+	clock = pg.time.Clock()
+	num_coords_predicted = 0
 	drawing = True
 	left_btn_down = False
 
 	while drawing:
+		clock.tick(30)  # Predict at most ~30 times/sec, with all mouse events since the last frame processed at once
+
 		for event in pg.event.get():
 			match event.type:
 				case pg.QUIT:
@@ -183,43 +204,46 @@ if __name__ == '__main__':
 				case pg.MOUSEBUTTONDOWN:
 					if event.button == 1:
 						left_btn_down = True
-						x, y = event.pos
-						user_drawing_coords = np.append(user_drawing_coords, [[x, y]], axis=0)
+						user_drawing_coords.append(event.pos)
 				case pg.MOUSEMOTION:
 					if left_btn_down:
-						x, y = event.pos
-						user_drawing_coords = np.append(user_drawing_coords, [[x, y]], axis=0)
+						user_drawing_coords.append(event.pos)
 				case pg.MOUSEBUTTONUP:
 					if event.button == 1:
 						left_btn_down = False
 
-		if not left_btn_down:
-			continue
+		if not left_btn_down or len(user_drawing_coords) == num_coords_predicted:
+			continue  # Nothing new drawn since the last prediction
+		num_coords_predicted = len(user_drawing_coords)
 
 		# Map coords to range [0,27]
-		pixelated_coords = user_drawing_coords * 27 / DRAWING_SIZE
-		pixelated_coords = np.unique(pixelated_coords.round(), axis=0).astype(int)  # Keep only unique coords
-		pixelated_coords = np.clip(pixelated_coords, 0, 27)
+		pixelated_coords = np.asarray(user_drawing_coords, dtype=np.float32) * 27 / DRAWING_SIZE
+		pixelated_coords = np.clip(pixelated_coords.round().astype(int), 0, 27)
+
+		# Keep only unique coords (via a 28x28 mask, rather than sorting rows with np.unique)
+		drawn_mask = np.zeros((28, 28), dtype=bool)
+		drawn_mask[pixelated_coords[:, 1], pixelated_coords[:, 0]] = True
+		ys, xs = drawn_mask.nonzero()
+		pixelated_coords = np.column_stack((xs, ys))
 
 		# Set these pixels as bright
 		model_input[pixelated_coords[:, 1], pixelated_coords[:, 0], :] = 1
 
-		# Add some edge blurring
-		for x, y in pixelated_coords:
-			for dx, dy in [(0, -1), (1, 0), (0, 1), (-1, 0)]:
-				if 0 <= x + dx <= 27 and 0 <= y + dy <= 27 and model_input[y + dy, x + dx, :] == 0:
-					model_input[y + dy, x + dx, :] = np.random.uniform(0.33, 1)
-
-		pred_vector = model.predict(np.expand_dims(model_input, 0), verbose=0)
-
-		for y in range(28):
-			for x in range(28):
-				colour = round(255 * model_input[y, x, 0])
-				pg.draw.rect(
-					scene,
-					(colour, colour, colour),
-					pg.Rect(x * DRAWING_CELL_SIZE, y * DRAWING_CELL_SIZE, DRAWING_CELL_SIZE, DRAWING_CELL_SIZE)
-				)
+		# Add some edge blurring (random brightness for any dark, in-bounds 4-neighbours of the drawn pixels)
+		neighbours = pixelated_coords[:, None, :] + np.array([[0, -1], [1, 0], [0, 1], [-1, 0]])
+		neighbours = neighbours.reshape(-1, 2)
+		neighbours = neighbours[((neighbours >= 0) & (neighbours <= 27)).all(axis=1)]
+		xs, ys = neighbours[:, 0], neighbours[:, 1]
+		dark = model_input[ys, xs, 0] == 0
+		model_input[ys[dark], xs[dark], 0] = np.random.uniform(0.33, 1, size=dark.sum())
+
+		# Call the model directly: predict() builds a new data pipeline on every call, which dominates for 1 sample
+		pred_vector = model(tf.convert_to_tensor(model_input)[None], training=False).numpy()
+
+		# Draw the canvas in one blit (surfarray is indexed (x, y), so transpose)
+		img = (model_input[..., 0] * 255).round().astype(np.uint8)
+		pg.surfarray.blit_array(canvas, np.stack([img.T] * 3, axis=-1))
+		scene.blit(pg.transform.scale(canvas, (DRAWING_SIZE, DRAWING_SIZE)), (0, 0))
 
 		pred_lbl = font.render(f'{pred_vector.argmax()} ({(100 * pred_vector.max()):.1f}% sure)', True, 'green')
 		scene.blit(pred_lbl, (10, 10))
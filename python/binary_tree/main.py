@@ -11,16 +11,17 @@ from binary_tree import Tree
 from tree_plotter import plot_tree
 
 
-def make_random_binary_tree(tree_size=31):
-	with open('C:/Users/Sam/Desktop/projects/datasets/people_names.txt', 'r') as file:
-		names = file.read().splitlines()
+with open('C:/Users/Sam/Desktop/projects/datasets/people_names.txt', 'r') as file:
+	NAMES = file.read().splitlines()  # Read once, not on every tree remake
+
 
-	assert tree_size <= len(names)
+def make_random_binary_tree(tree_size=31):
+	assert tree_size <= len(NAMES)
 
-	random.shuffle(names)
+	names = random.sample(NAMES, tree_size)
 	bin_tree = Tree(names[0])
 
-	for name in names[1:tree_size]:
+	for name in names[1:]:
 		bin_tree.insert(name)
 
 	return bin_tree
@@ -37,20 +38,21 @@ def display_tree_info(tree):
 	print('Balanced:', tree.is_balanced())
 
 
-def make_balanced_bst(data, lo=0, hi=None):
-	data.sort()
+def make_balanced_bst(data):
+	def build(lo, hi):
+		if lo > hi:
+			return None
+
+		mid = (lo + hi) // 2
 
-	if hi is None:
-		hi = len(data) - 1
-	if lo > hi:
-		return None
+		tree = Tree(data[mid])
+		tree.left_child = build(lo, mid - 1)
+		tree.right_child = build(mid + 1, hi)
+		return tree
 
-	mid = (lo + hi) // 2
+	data = sorted(data)  # Sort once, not on every recursive call
 
-	tree = Tree(data[mid])
-	tree.left_child = make_balanced_bst(data, lo, mid - 1)
-	tree.right_child = make_balanced_bst(data, mid + 1, hi)
-	return tree
+	return build(0, len(data) - 1)
 
 
 if __name__ == '__main__':